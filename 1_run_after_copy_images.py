@@ -18,6 +18,11 @@ Result (per ID):
       metadata.json
     <ID>.iris/segmentation/<ID>/{1_final.npy, 1_user.npy, mask.png}  # from f_1dpwseg.tif if exists
 
+Optional: Pillow-SIMD is a drop-in Pillow build that speeds up mask.png encoding
+  pip uninstall -y pillow && pip install pillow-simd
+and orjson, if installed, is used to write the JSON files
+  pip install orjson
+
 Run:
   python run_iris_prep.py
 Then:
@@ -25,17 +30,30 @@ Then:
 """
 
 from pathlib import Path
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
 import os, json
 import numpy as np
 import rasterio as rio
 from rasterio.warp import transform
+from rasterio.windows import Window
 from PIL import Image
+try:
+    import orjson  # optional, much faster JSON encoding
+except ImportError:
+    orjson = None
 
 # ---------------- CONFIG ----------------
 BASE_JSON       = "base.json"          # base template for per-ID project
 IMAGES_ROOT     = Path("spot/images")  # where {id}/rgb.tif (and f_1dpwseg.tif) live
 MASK_TIF_NAME   = "f_1dpwseg.tif"      # input mask values may be 0/1/255 (255 will be remapped to 0)
 OVERWRITE_JSON  = True                 # overwrite <ID>.json if exists
+RGB_DTYPE       = None                 # rgb.npy dtype; None -> tif dtype if integer <= 2 bytes, else float32
+SKIP_UP_TO_DATE = True                 # keep rgb.npy / mask caches built from the same source tif (size + mtime)
+MAX_WORKERS     = os.cpu_count()       # parallel processes (one ID per task)
+READ_CHUNK_MB   = 64                   # rgb.tif is streamed in full-width row bands of ~this size
+GDAL_CACHE_MB   = 1024                 # GDAL block cache budget (MB), split across workers
 # Two-class setup: 0 -> Clear, 1 -> Cloud. No "NoData" class anymore.
 CLASS_MAP = {0: "Clear", 1: "Cloud"}
 # ---------------------------------------
@@ -46,32 +64,168 @@ def list_ids(root: Path):
     return sorted([p.name for p in root.iterdir() if p.is_dir()])
 
 
-def write_rgb_npy_to_dest(tif_path: Path, dest_npy: Path):
-    """Create rgb.npy directly in destination from rgb.tif (H,W,C float32)."""
-    if dest_npy.is_symlink() or dest_npy.exists():
-        dest_npy.unlink()
-    with rio.open(tif_path) as src:
-        arr = src.read()                            # (C,H,W)
-    arr = np.moveaxis(arr, 0, -1).astype("float32") # (H,W,C)
-    dest_npy.parent.mkdir(parents=True, exist_ok=True)
-    np.save(dest_npy, arr, allow_pickle=False)
-    print(f"  [+] {dest_npy.parent.parent.name}: dest rgb.npy created")
+def set_gdal_env(n_workers: int):
+    """
+    Size GDAL per worker process so the whole pool uses about cpu_count threads
+    and GDAL_CACHE_MB of block cache. Set in os.environ before the pool starts
+    (workers inherit it; GDAL reads it lazily); values already set by the user win.
+    """
+    gdal_env = {
+        "GDAL_NUM_THREADS": str(max(1, (os.cpu_count() or 1) // n_workers)),  # tif decompression
+        "GDAL_CACHEMAX":    str(max(1, GDAL_CACHE_MB // n_workers)),           # block cache (MB)
+        "VSI_CACHE":        "TRUE",                                            # cache file reads
+    }
+    for key, value in gdal_env.items():
+        os.environ.setdefault(key, value)
 
 
-def get_width_height_from_tif(tif_path: Path):
-    with rio.open(tif_path) as src:
-        return src.width, src.height  # (W,H)
+def rgb_npy_dtype(src_dtype):
+    """
+    dtype for rgb.npy: RGB_DTYPE if set (e.g. "float16" to halve float data); else
+    the tif's own dtype for integers of <= 2 bytes (e.g. uint16: lossless at
+    2 bytes/pixel); else float32. IRIS upcasts compact dtypes when loading.
+    """
+    if RGB_DTYPE is not None:
+        return np.dtype(RGB_DTYPE)
+    src_dtype = np.dtype(src_dtype)
+    if src_dtype.kind in "iu" and src_dtype.itemsize <= 2:
+        return src_dtype
+    return np.dtype(np.float32)
+
+
+def write_json(path: Path, obj):
+    """Write obj as 2-space indented JSON (orjson if installed, else json)."""
+    if orjson is not None:
+        path.write_bytes(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    else:
+        path.write_text(json.dumps(obj, indent=2), encoding="utf-8")
+
+
+def source_stamp(source: Path, **options):
+    """Identity of the source a cache is built from: size, mtime (ns) and build options."""
+    st = source.stat()
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, **options}
+
+
+def stamp_path(target: Path):
+    return target.with_name(target.name + ".stamp")
+
+
+def write_stamp(target: Path, stamp: dict):
+    """Record the source stamp next to a cache once the cache is complete."""
+    stamp_path(target).write_text(json.dumps(stamp), encoding="utf-8")
 
 
-def compute_center_latlon(tif_path: Path):
-    """Return (lat, lon) of raster center in WGS84. None if CRS missing."""
+def is_up_to_date(target: Path, stamp: dict):
+    """
+    True if target is a real file whose recorded source stamp equals stamp.
+    Equality (not mtime order): copies made with cp -p / rsync -a keep old mtimes.
+    """
+    if not SKIP_UP_TO_DATE or target.is_symlink() or not target.exists():
+        return False
+    try:
+        return json.loads(stamp_path(target).read_text(encoding="utf-8")) == stamp
+    except (OSError, ValueError):
+        return False
+
+
+def npy_header(path: Path):
+    """(shape, dtype) of a complete .npy file, or None if missing or truncated."""
+    try:
+        arr = np.load(path, mmap_mode="r", allow_pickle=False)
+    except (OSError, ValueError):
+        return None
+    return arr.shape, arr.dtype
+
+
+def tmp_path(path: Path):
+    """Sibling path to write into before os.replace()-ing it onto path."""
+    return path.with_name(path.name + ".tmp")
+
+
+def write_rgb_npy(src, dest_npy: Path, shape: tuple, dtype):
+    """
+    Stream src into a new (H,W,C) .npy at dest_npy in full-width row bands of
+    ~READ_CHUNK_MB (whole tif blocks each), so peak memory stays bounded while
+    each read spans many blocks for GDAL's decode threads. Each row band is
+    decoded in the tif dtype and cast on assignment (GDAL has no float16 type).
+    Returns False, leaving a partial file, if values do not fit a float dtype
+    narrower than the tif's (they would silently become inf).
+    """
+    H, W, C = shape
+    src_dtype = np.dtype(src.dtypes[0])
+    limit = np.finfo(dtype).max if dtype.kind == "f" and dtype != src_dtype else None
+    block_h = src.block_shapes[0][0]
+    row_bytes = W * C * src_dtype.itemsize
+    band_h = max(block_h, (READ_CHUNK_MB * 2**20 // row_bytes) // block_h * block_h)
+
+    mm = np.lib.format.open_memmap(dest_npy, mode="w+", dtype=dtype, shape=shape)
+    for row0 in range(0, H, band_h):
+        window = Window(0, row0, W, min(band_h, H - row0))
+        chunk = src.read(window=window)  # (C,rows,W)
+        if limit is not None and np.fmax.reduce(np.abs(chunk), axis=None) > limit:
+            return False
+        mm[row0:row0 + window.height] = chunk.transpose(1, 2, 0)
+    mm.flush()
+    return True
+
+
+def process_tif(tif_path: Path, dest_npy: Path):
+    """
+    Single open of rgb.tif: create rgb.npy directly in destination (H,W,C, see rgb_npy_dtype)
+    and return (W, H, center), center being (crs_wkt, cx, cy) or None if CRS missing.
+    rgb.npy is not rewritten if its stamp matches rgb.tif (size, mtime, RGB_DTYPE)
+    and it has the expected shape and dtype (float32 if the configured dtype
+    overflowed). It is written to a temporary file and only moved into place
+    once complete, so an interrupted run never leaves a partial rgb.npy behind.
+    """
+    dest_npy.parent.mkdir(parents=True, exist_ok=True)
     with rio.open(tif_path) as src:
-        if src.crs is None:
-            return None
-        cx = (src.bounds.left + src.bounds.right) / 2
-        cy = (src.bounds.bottom + src.bounds.top) / 2
-        lon, lat = transform(src.crs, "EPSG:4326", [cx], [cy])
-        return float(lat[0]), float(lon[0])
+        W, H = src.width, src.height
+        center = None
+        if src.crs is not None:
+            cx = (src.bounds.left + src.bounds.right) / 2
+            cy = (src.bounds.bottom + src.bounds.top) / 2
+            center = (src.crs.to_wkt(), cx, cy)
+
+        dtype = rgb_npy_dtype(src.dtypes[0])
+        shape = (H, W, src.count)  # (H,W,C)
+        stamp = source_stamp(tif_path, rgb_dtype=RGB_DTYPE)
+        if (is_up_to_date(dest_npy, stamp)
+                and npy_header(dest_npy) in ((shape, dtype), (shape, np.dtype(np.float32)))):
+            print(f"  [=] {dest_npy.parent.parent.name}: dest rgb.npy up to date -> skip")
+            return W, H, center
+
+        tmp_npy = tmp_path(dest_npy)
+        try:
+            if not write_rgb_npy(src, tmp_npy, shape, dtype):
+                print(f"  [!] {dest_npy.parent.parent.name}: values exceed {dtype} -> rgb.npy as float32")
+                write_rgb_npy(src, tmp_npy, shape, np.dtype(np.float32))
+        except BaseException:
+            tmp_npy.unlink(missing_ok=True)
+            raise
+    os.replace(tmp_npy, dest_npy)  # also replaces a symlink left by old runs
+    write_stamp(dest_npy, stamp)
+    print(f"  [+] {dest_npy.parent.parent.name}: dest rgb.npy created")
+    return W, H, center
+
+
+def centers_to_latlon(centers: dict):
+    """
+    Transform {id: (crs_wkt, cx, cy)} to {id: (lat, lon)} in WGS84.
+    IDs are grouped by CRS so PROJ is set up once per distinct CRS, not per ID.
+    """
+    by_crs = defaultdict(list)
+    for id_name, (crs, cx, cy) in centers.items():
+        by_crs[crs].append((id_name, cx, cy))
+
+    latlons = {}
+    for crs, items in by_crs.items():
+        names, xs, ys = zip(*items)
+        lons, lats = transform(crs, "EPSG:4326", list(xs), list(ys))
+        for id_name, lat, lon in zip(names, lats, lons):
+            latlons[id_name] = (float(lat), float(lon))
+    return latlons
 
 
 def safe_make_clean_dest_dir(path: Path):
@@ -97,60 +251,133 @@ def remove_source_rgb_npy(id_src_dir: Path):
 
 # --------- IRIS caches from mask (2-class remap) ---------
 def build_caches_from_mask(id_src_dir: Path, proj_dir: Path, proj_name: str,
-                           classes: list[str], class_colors: list[tuple[int,int,int]]):
+                           class_to_idx: dict[str, int], class_colors: list[tuple[int,int,int]]):
     """
     Read f_1dpwseg.tif from SOURCE and create in PROJECT:
       <proj>/<name>.iris/segmentation/<ID>/1_final.npy  (H,W,K) bool
       <proj>/<name>.iris/segmentation/<ID>/1_user.npy   (H,W)   bool
-      mask.png (colored visualization)
+      mask.png (colored visualization, RGB)
 
     Two-class policy:
       - Remap 255 -> 0 (i.e., treat 255 as Clear).
       - Map value 0 to Clear; value 1 to Cloud.
       - Any other value (2..254) is treated as Cloud as a fallback.
       - user mask is fully valid (all True), since there is no NoData.
+    Caches built from the same f_1dpwseg.tif (size + mtime stamp) are left
+    untouched, including edits saved from IRIS. 1_final.npy is written last
+    (temporary file + os.replace), then its stamp, so a stamp means the other
+    two outputs are complete.
     """
     tif_mask = id_src_dir / MASK_TIF_NAME
     if not tif_mask.exists():
         return
+    seg_dir = proj_dir / f"{proj_name}.iris" / "segmentation" / id_src_dir.name
+    final_npy = seg_dir / "1_final.npy"
+    K = len(class_colors)  # class_to_idx is only for name lookups (names may repeat)
+    header = npy_header(final_npy)
+    stamp = source_stamp(tif_mask)
+    if (is_up_to_date(final_npy, stamp) and header is not None
+            and header[0][-1:] == (K,) and header[1] == bool
+            and (seg_dir / "1_user.npy").exists() and (seg_dir / "mask.png").exists()):
+        print(f"  [=] {proj_name}: mask caches up to date -> skip")
+        return
 
     with rio.open(tif_mask) as src:
-        m = src.read(1).astype("uint8")
-
-    # --- Remap 255 -> 0 to drop NoData and keep only two classes ---
-    m = np.where(m == 255, 0, m)
+        # decode straight into uint8 (no intermediate in the tif's own dtype)
+        m = src.read(1, out=np.empty((src.height, src.width), dtype=np.uint8))
 
-    H, W = m.shape
-    K = len(classes)
-    onehot = np.zeros((H, W, K), dtype=bool)
+    # --- Lookup table: mask value (0..255) -> class index (K = no class) ---
+    lut = np.full(256, K, dtype=np.uint8)
 
-    # Map 0 -> Clear
-    if "Clear" in classes:
-        k_clear = classes.index("Clear")
-        onehot[:, :, k_clear] |= (m == 0)
+    # Map 0 -> Clear, and remap 255 -> 0 (Clear) to drop NoData
+    if "Clear" in class_to_idx:
+        k_clear = class_to_idx["Clear"]
+        lut[[0, 255]] = k_clear
 
     # Map 1 -> Cloud and also treat any 2..254 as Cloud (fallback)
-    if "Cloud" in classes:
-        k_cloud = classes.index("Cloud")
-        onehot[:, :, k_cloud] |= (m == 1)
-        onehot[:, :, k_cloud] |= (m > 1)  # values 2..254 become Cloud
+    if "Cloud" in class_to_idx:
+        k_cloud = class_to_idx["Cloud"]
+        lut[1:255] = k_cloud
+
+    class_idx = lut[m]  # (H,W) uint8, single gather
+    H, W = class_idx.shape
 
     # All pixels are valid now (no NoData)
     user = np.ones((H, W), dtype=bool)
 
-    seg_dir = proj_dir / f"{proj_name}.iris" / "segmentation" / id_src_dir.name
     seg_dir.mkdir(parents=True, exist_ok=True)
-    np.save(seg_dir / "1_final.npy", onehot)
-    np.save(seg_dir / "1_user.npy",  user)
+    np.save(seg_dir / "1_user.npy",  user, allow_pickle=False)
 
-    # Color preview
-    rgbmask = np.zeros((H, W, 3), dtype=np.uint8)
-    for k, _n in enumerate(classes):
-        rgbmask[onehot[:, :, k]] = class_colors[k]
-    Image.fromarray(rgbmask, "RGB").save(seg_dir / "mask.png", optimize=True)
+    # Color preview: RGB PNG like IRIS writes it ("mask_encoding": "rgb"), from a
+    # single palette gather (K colours + black for "no class"), fast zlib
+    palette = np.asarray([*class_colors, (0, 0, 0)], dtype=np.uint8)
+    Image.fromarray(palette[class_idx], "RGB").save(seg_dir / "mask.png", optimize=False, compress_level=1)
+
+    # one-hot (H,W,K) is computed straight into a memory-mapped temporary file,
+    # moved onto 1_final.npy once complete
+    tmp_final = tmp_path(final_npy)
+    try:
+        final = np.lib.format.open_memmap(tmp_final, mode="w+", dtype=bool, shape=(H, W, K))
+        np.equal(class_idx[..., None], np.arange(K, dtype=np.uint8), out=final)
+        final.flush()
+        del final
+    except BaseException:
+        tmp_final.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_final, final_npy)
+    write_stamp(final_npy, stamp)
 
 
 # --------- Project creation ---------
+def process_id(id_name: str, base_blob: str, class_to_idx: dict[str, int],
+               class_colors: list[tuple[int,int,int]], base_dir: Path, images_root: Path):
+    """
+    Build the IRIS project of a single ID (independent of every other ID).
+    base_blob is base.json serialized once by the caller (cheap per-ID copy).
+    Returns ('iris label ...' launcher line, center), or None if the ID was skipped.
+    """
+    id_src_dir = images_root / id_name
+    tif_rgb = id_src_dir / "rgb.tif"
+    if not tif_rgb.exists():
+        print(f"[{id_name}] no rgb.tif -> skip")
+        return None
+
+    # project folder
+    proj_dir = base_dir / "spot" / id_name
+    proj_dir.mkdir(parents=True, exist_ok=True)
+
+    # project images/<ID>: real directory (no symlinked tree)
+    proj_images_id_dir = proj_dir / "images" / id_name
+    safe_make_clean_dest_dir(proj_images_id_dir)
+
+    # create rgb.npy ONLY in DEST; shape and raster center (native CRS) come
+    # from the same open. lat/lon + metadata.json are done in batch by the caller
+    dest_npy = proj_images_id_dir / "rgb.npy"
+    W, H, center = process_tif(tif_rgb, dest_npy)
+    print(f"[{id_name}] shape: {W}x{H}")
+
+    # ensure no rgb.npy remains in SOURCE
+    remove_source_rgb_npy(id_src_dir)
+
+    # per-ID JSON (fresh copy of base, parsed from the pre-serialized blob)
+    proj_json = proj_dir / f"{id_name}.json"
+    cfg = json.loads(base_blob)
+    cfg["name"] = id_name
+    cfg["images"]["path"] = "images/{id}/rgb.npy"
+    cfg["images"]["shape"] = [W, H]
+    cfg.setdefault("segmentation", {})
+    cfg["segmentation"]["mask_area"] = [0, 0, W, H]
+
+    if OVERWRITE_JSON or not proj_json.exists():
+        write_json(proj_json, cfg)
+        print(f"  [+] JSON: {proj_json}")
+
+    # caches from mask (SOURCE -> PROJECT, 2-class)
+    build_caches_from_mask(id_src_dir, proj_dir, id_name, class_to_idx, class_colors)
+
+    return f"iris label {proj_json}", center
+
+
 def create_projects_per_id(base_json_path: Path, images_root: Path):
     if not base_json_path.exists():
         raise FileNotFoundError(f"Missing {base_json_path.name}")
@@ -159,7 +386,7 @@ def create_projects_per_id(base_json_path: Path, images_root: Path):
 
     with open(base_json_path, "r", encoding="utf-8") as f:
         base_cfg = json.load(f)
-    classes = [c["name"] for c in base_cfg["classes"]]
+    class_to_idx = {c["name"]: k for k, c in enumerate(base_cfg["classes"])}
     class_colors = [tuple(c["colour"][:3]) for c in base_cfg["classes"]]
 
     ids = list_ids(images_root)
@@ -167,62 +394,44 @@ def create_projects_per_id(base_json_path: Path, images_root: Path):
         print("No IDs in spot/images. Nothing to do.")
         return
 
-    run_lines = []
-
-    for id_name in ids:
-        id_src_dir = images_root / id_name
-        tif_rgb = id_src_dir / "rgb.tif"
-        if not tif_rgb.exists():
-            print(f"[{id_name}] no rgb.tif -> skip")
-            continue
-
-        # shape from source TIFF
-        W, H = get_width_height_from_tif(tif_rgb)
-        print(f"[{id_name}] shape: {W}x{H}")
-
-        # project folder
-        proj_dir = base_json_path.parent / "spot" / id_name
-        proj_dir.mkdir(parents=True, exist_ok=True)
-
-        # project images/<ID>: real directory (no symlinked tree)
-        proj_images_id_dir = proj_dir / "images" / id_name
-        safe_make_clean_dest_dir(proj_images_id_dir)
-
-        # create rgb.npy ONLY in DEST
-        dest_npy = proj_images_id_dir / "rgb.npy"
-        write_rgb_npy_to_dest(tif_rgb, dest_npy)
-
-        # write metadata.json ONLY in DEST
-        latlon = compute_center_latlon(tif_rgb)
-        if latlon is None:
+    # IDs are independent (disk IO + numpy per scene) -> one process per ID
+    n_workers = max(1, min(MAX_WORKERS or 1, len(ids)))
+    set_gdal_env(n_workers)
+
+    # serialize the template once; workers only parse it
+    base_blob = json.dumps(base_cfg)
+    worker = partial(process_id, base_blob=base_blob, class_to_idx=class_to_idx, class_colors=class_colors,
+                     base_dir=base_json_path.parent, images_root=images_root)
+    done, failed = {}, []
+    with ProcessPoolExecutor(max_workers=n_workers) as ex:
+        futures = {ex.submit(worker, id_name): id_name for id_name in ids}
+        for future in as_completed(futures):
+            id_name = futures[future]
+            try:
+                res = future.result()
+            except Exception as e:
+                # one bad scene must not cost the other IDs their outputs
+                print(f"[{id_name}] ERROR: {e!r}")
+                failed.append(id_name)
+                continue
+            if res:
+                done[id_name] = res
+    results = [(id_name, done[id_name]) for id_name in ids if id_name in done]  # ID order
+    run_lines = [line for _id, (line, _center) in results]
+
+    # write metadata.json ONLY in DEST (one CRS transform per distinct CRS)
+    latlons = centers_to_latlon({
+        id_name: center for id_name, (_line, center) in results if center is not None
+    })
+    for id_name, _res in results:
+        if id_name not in latlons:
             print(f"[{id_name}] WARNING: no CRS -> create metadata.json manually with 'location: [lat,lon]'")
-        else:
-            lat, lon = latlon
-            meta = {"scene_id": id_name, "location": [lat, lon]}
-            (proj_images_id_dir / "metadata.json").write_text(json.dumps(meta, indent=2), encoding="utf-8")
-            print(f"[{id_name}] metadata.json -> location {lon:.6f}, {lat:.6f}")
-
-        # ensure no rgb.npy remains in SOURCE
-        remove_source_rgb_npy(id_src_dir)
-
-        # per-ID JSON (deep copy of base)
-        proj_json = proj_dir / f"{id_name}.json"
-        cfg = json.loads(json.dumps(base_cfg))  # deep copy
-        cfg["name"] = id_name
-        cfg["images"]["path"] = "images/{id}/rgb.npy"
-        cfg["images"]["shape"] = [W, H]
-        cfg.setdefault("segmentation", {})
-        cfg["segmentation"]["mask_area"] = [0, 0, W, H]
-
-        if OVERWRITE_JSON or not proj_json.exists():
-            with open(proj_json, "w", encoding="utf-8") as f:
-                json.dump(cfg, f, indent=2)
-            print(f"  [+] JSON: {proj_json}")
-
-        # caches from mask (SOURCE -> PROJECT, 2-class)
-        build_caches_from_mask(id_src_dir, proj_dir, id_name, classes, class_colors)
-
-        run_lines.append(f"iris label {proj_json}")
+            continue
+        lat, lon = latlons[id_name]
+        proj_images_id_dir = base_json_path.parent / "spot" / id_name / "images" / id_name
+        meta = {"scene_id": id_name, "location": [lat, lon]}
+        write_json(proj_images_id_dir / "metadata.json", meta)
+        print(f"[{id_name}] metadata.json -> location {lon:.6f}, {lat:.6f}")
 
     # launcher script
     run_sh = base_json_path.parent / "run_all_projects.sh"
@@ -233,6 +442,8 @@ def create_projects_per_id(base_json_path: Path, images_root: Path):
     os.chmod(run_sh, 0o755)
 
     print("\nDone.")
+    if failed:
+        print(f"Failed IDs ({len(failed)}): {', '.join(sorted(failed))}")
     print("Launch a single project with:")
     if run_lines:
         print(" ", run_lines[0])
@@ -237,6 +237,11 @@ class Project:
             array = np.load(filename, mmap_mode='r', allow_pickle=False)
             if bands is not None:
                 array = array[..., bands]
+            # Compact on-disk dtypes (e.g. uint16, float16) are upcast lazily,
+            # so band expressions like "$B4-$B3" do not wrap or overflow:
+            array = array.astype(
+                np.result_type(array.dtype, np.float32), copy=False
+            )
         elif filename.lower().endswith('vrt'):
             with rio.open(filename) as file:
                 array = file.read(bands)